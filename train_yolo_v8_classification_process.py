@@ -17,21 +17,33 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import copy
-from ikomia import core, dataprocess
+import functools
+import types
+from ikomia import core, dataprocess, utils
 from ikomia.core.task import TaskParam
 from ikomia.dnn import dnntrain
 import os
-import yaml
-from ultralytics import YOLO
-from datetime import datetime
-import torch
-from train_yolo_v8_classification.utils import custom_callbacks
-from ultralytics import download
+import shutil
 
-from ultralytics import download, settings
+_MODULE_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+@functools.lru_cache(maxsize=8)
+def _parse_yaml(path, mtime):
+    import yaml
+    try:
+        loader = yaml.CSafeLoader
+    except AttributeError:
+        # PyYAML built without libyaml
+        loader = yaml.SafeLoader
+    with open(path, 'r') as file:
+        return types.MappingProxyType(yaml.load(file, Loader=loader))
+
+
+def _load_yaml(path):
+    # mtime in the cache key reloads the file when it is edited
+    return _parse_yaml(path, os.path.getmtime(path))
 
-# Update a setting
-settings.update({'mlflow': False})
 
 # --------------------
 # - Class to handle the process parameters
@@ -43,22 +55,33 @@ class TrainYoloV8ClassificationParam(TaskParam):
 
     def __init__(self):
         TaskParam.__init__(self)
-        dataset_folder = os.path.join(os.path.dirname(
-            os.path.realpath(__file__)), "dataset")
+        dataset_folder = os.path.join(_MODULE_DIR, "dataset")
         self.cfg["dataset_folder"] = dataset_folder
         self.cfg["model_name"] = "yolov8m-cls"
         self.cfg["epochs"] = 100
-        self.cfg["batch_size"] = 8
+        # -1: AutoBatch, largest batch fitting in GPU memory
+        self.cfg["batch_size"] = -1
         self.cfg["input_size"] = 640
-        self.cfg["workers"] = 0
+        self.cfg["workers"] = min(8, max(1, (os.cpu_count() or 2) // 2))
         self.cfg["optimizer"] = "auto"
         self.cfg["weight_decay"] = 0.0005
         self.cfg["momentum"] = 0.937
         self.cfg["lr0"] = 0.01
         self.cfg["lrf"] = 0.01
+        self.cfg["device"] = ""
+        self.cfg["prefetch"] = False
+        self.cfg["amp"] = True
+        # "", "ram" or "disk"
+        self.cfg["cache"] = ""
+        self.cfg["enable_tensorboard"] = True
+        self.cfg["enable_mlflow"] = False
+        self.cfg["val"] = True
+        self.cfg["val_period"] = 1
+        # Experiment folder name in output_folder (timestamp if empty)
+        self.cfg["name"] = ""
+        self.cfg["resume"] = False
         self.cfg["config_file"] = ""
-        self.cfg["output_folder"] = os.path.dirname(
-            os.path.realpath(__file__)) + "/runs/"
+        self.cfg["output_folder"] = _MODULE_DIR + "/runs/"
 
     def set_values(self, param_map):
         self.cfg["dataset_folder"] = str(param_map["dataset_folder"])
@@ -66,11 +89,25 @@ class TrainYoloV8ClassificationParam(TaskParam):
         self.cfg["epochs"] = int(param_map["epochs"])
         self.cfg["batch_size"] = int(param_map["batch_size"])
         self.cfg["input_size"] = int(param_map["input_size"])
-        self.cfg["workers"] = int(param_map["workers"])
+        self.cfg["workers"] = min(max(0, int(param_map["workers"])), os.cpu_count() or 1)
         self.cfg["optimizer"] = str(param_map["optimizer"])
         self.cfg["momentum"] = float(param_map["momentum"])
         self.cfg["lr0"] = float(param_map["lr0"])
         self.cfg["lrf"] = float(param_map["lrf"])
+        self.cfg["device"] = str(param_map["device"])
+        self.cfg["prefetch"] = utils.strtobool(param_map["prefetch"])
+        self.cfg["amp"] = utils.strtobool(param_map["amp"])
+        cache = str(param_map["cache"]).strip().lower()
+        cache = {"true": "ram", "false": ""}.get(cache, cache)
+        if cache not in ("", "ram", "disk"):
+            raise ValueError(f"Invalid cache value '{param_map['cache']}': expected '', 'ram' or 'disk'")
+        self.cfg["cache"] = cache
+        self.cfg["enable_tensorboard"] = utils.strtobool(param_map["enable_tensorboard"])
+        self.cfg["enable_mlflow"] = utils.strtobool(param_map["enable_mlflow"])
+        self.cfg["val"] = utils.strtobool(param_map["val"])
+        self.cfg["val_period"] = max(1, int(param_map["val_period"]))
+        self.cfg["name"] = str(param_map["name"])
+        self.cfg["resume"] = utils.strtobool(param_map["resume"])
         self.cfg["config_file"] = param_map["config_file"]
         self.cfg["output_folder"] = str(param_map["output_folder"])
 
@@ -80,6 +117,9 @@ class TrainYoloV8ClassificationParam(TaskParam):
 # - Inherits PyCore.CWorkflowTask or derived from Ikomia API
 # --------------------
 class TrainYoloV8Classification(dnntrain.TrainProcess):
+    # Pristine YOLO models loaded from disk, keyed by (weights file, mtime)
+    _model_cache = {}
+    _model_cache_size = 4
 
     def __init__(self, name, param):
         dnntrain.TrainProcess.__init__(self, name, param)
@@ -91,11 +131,15 @@ class TrainYoloV8Classification(dnntrain.TrainProcess):
         if param is None:
             self.set_param_object(TrainYoloV8ClassificationParam())
         else:
-            self.set_param_object(copy.deepcopy(param))
+            # cfg only holds primitives: a shallow copy is enough
+            new_param = TrainYoloV8ClassificationParam()
+            new_param.cfg = dict(param.cfg)
+            self.set_param_object(new_param)
 
-        self.enable_tensorboard(True)
-        self.enable_mlflow(True)
-        self.device = torch.device("cpu")
+        cfg = self.get_param_object().cfg
+        self.enable_tensorboard(cfg.get("enable_tensorboard", True))
+        self.enable_mlflow(cfg.get("enable_mlflow", False))
+        self.device = "cpu"
         self.model_weights = None
         self.model = None
         self.stop_training = False
@@ -108,72 +152,200 @@ class TrainYoloV8Classification(dnntrain.TrainProcess):
         return 1
 
     def run(self):
+        # Heavy imports deferred here so plugin discovery stays fast
+        import torch
+        from datetime import datetime
+        from ultralytics import YOLO, download, settings
+        from ultralytics.utils import LOGGER
+        from train_yolo_v8_classification.utils import custom_callbacks
+
+        # Get parameters
+        param = self.get_param_object()
+
+        # Parameters may have changed since construction
+        self.enable_tensorboard(param.cfg["enable_tensorboard"])
+        self.enable_mlflow(param.cfg["enable_mlflow"])
+
         # Core function of your process
         # Call begin_task_run() for initialization
         self.begin_task_run()
 
-        # Get parameters
-        param = self.get_param_object()
+        # Update a setting
+        settings.update({'mlflow': False})
 
         # Get dataset path from input
         path_input = self.get_input(0)
         dataset_folder = path_input.get_path()
 
-        # Create a YOLO model instance
-        self.device = 0 if torch.cuda.is_available() else torch.device("cpu")
-        if param.cfg["config_file"] != "":
-            # Load the YAML config file
-            with open(param.cfg["config_file"], 'r') as file:
-                config_file = yaml.safe_load(file)
-            self.model_weights = config_file["model"]
+        # Select device(s): several GPUs (e.g. "0,1") trigger Ultralytics DDP training
+        if param.cfg["device"]:
+            self.device = param.cfg["device"]
+        elif torch.cuda.is_available():
+            self.device = 0
         else:
-            # Set path
-            model_folder = os.path.join(os.path.dirname(
-                os.path.realpath(__file__)), "weights")
-            self.model_weights = os.path.join(
-                str(model_folder), f'{param.cfg["model_name"]}.pt')
-            # Download model if not exist
-            if not os.path.isfile(self.model_weights):
-                url = f'https://github.com/{self.repo}/releases/download/{self.version}/{param.cfg["model_name"]}.pt'
-                download(url=url, dir=model_folder, unzip=True)
-        self.model = YOLO(self.model_weights)
-
-        # Add custom MLflow callback to the model
-        self.model.add_callback(
-            'on_fit_epoch_end', custom_callbacks.on_fit_epoch_end)
-
-        # Create output folder
-        experiment_name = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        os.makedirs(param.cfg["output_folder"], exist_ok=True)
-        output_folder = os.path.join(
-            param.cfg["output_folder"], experiment_name)
-        os.makedirs(output_folder, exist_ok=True)
-
-        # Train the model
-        if param.cfg["config_file"]:
-            # Extract the custom argument-value pairs
-            custom_args = {k: v for k, v in config_file.items()}
-            self.model.train(**custom_args)
+            self.device = "cpu"
 
-        else:
-            self.model.train(
-                data=dataset_folder,
-                epochs=param.cfg["epochs"],
-                imgsz=param.cfg["input_size"],
-                batch=param.cfg["batch_size"],
-                workers=param.cfg["workers"],
-                optimizer=param.cfg["optimizer"],
-                momentum=param.cfg["momentum"],
-                weight_decay=param.cfg["weight_decay"],
-                lr0=param.cfg["lr0"],
-                lrf=param.cfg["lrf"],
-                pretrained=True,
-                device=self.device,
-                project=output_folder,
-            )
-
-        # Reset settings to default values
-        settings.reset()
+        if "," in str(self.device):
+            # DDP workers are spawned from a generated script that does not get our callbacks
+            LOGGER.warning("Multi-GPU (DDP) training: MLflow metrics, prefetch, torch.compile, "
+                           "channels_last and val_period are not applied")
+
+        # Process-wide thread settings: restored once training is done
+        prev_num_threads = torch.get_num_threads()
+        prev_mkldnn = torch.backends.mkldnn.enabled
+        if self.device == "cpu":
+            # Use the cores this process may actually run on (containers, taskset)
+            n_threads = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+            torch.set_num_threads(n_threads)
+            torch.backends.mkldnn.enabled = True
+
+        # TF32 tensor cores and cuDNN autotuning (fixed input size)
+        # Process-wide flags: restored once training is done for other tasks
+        prev_backends = (torch.backends.cuda.matmul.allow_tf32,
+                         torch.backends.cudnn.allow_tf32,
+                         torch.backends.cudnn.benchmark)
+        prev_matmul_precision = None
+        if hasattr(torch, "set_float32_matmul_precision"):
+            prev_matmul_precision = torch.get_float32_matmul_precision()
+            torch.set_float32_matmul_precision("high")
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.backends.cudnn.benchmark = True
+
+        try:
+            # Create output folder
+            experiment_name = param.cfg["name"] or f"{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            os.makedirs(param.cfg["output_folder"], exist_ok=True)
+            output_folder = os.path.join(
+                param.cfg["output_folder"], experiment_name)
+            os.makedirs(output_folder, exist_ok=True)
+
+            if param.cfg["config_file"] != "":
+                # Load the YAML config file
+                config_file = _load_yaml(param.cfg["config_file"])
+                self.model_weights = config_file["model"]
+                # Same run folder layout as the parameter based training, unless set in the config
+                train_args = {"project": output_folder, "name": "train", **config_file}
+            else:
+                train_args = {"project": output_folder, "name": "train"}
+            run_folder = os.path.join(train_args["project"], train_args["name"])
+
+            # Resume an interrupted run of the same experiment
+            last_ckpt = os.path.join(run_folder, "weights", "last.pt")
+            resume = False
+            if param.cfg["resume"] and os.path.isfile(last_ckpt):
+                self.model = YOLO(last_ckpt)
+                # Finished runs are stripped by Ultralytics: epoch -1 and no optimizer state
+                resume = self.model.ckpt.get("epoch", -1) != -1 and self.model.ckpt.get("optimizer") is not None
+                if not resume:
+                    LOGGER.warning(f"{last_ckpt} comes from a finished training, starting a new one")
+
+            own_run_folder = run_folder == os.path.join(output_folder, "train")
+            if not resume and own_run_folder and os.path.isdir(run_folder):
+                # Ultralytics appends to results.csv and keeps old weights: start from a clean folder
+                LOGGER.warning(f"Removing previous results of experiment {experiment_name} in {run_folder}")
+                shutil.rmtree(run_folder)
+
+            # Create a YOLO model instance
+            if param.cfg["config_file"] == "":
+                # Set path
+                model_folder = os.path.join(_MODULE_DIR, "weights")
+                self.model_weights = os.path.join(
+                    str(model_folder), f'{param.cfg["model_name"]}.pt')
+                # Download model if not exist
+                if not os.path.isfile(self.model_weights):
+                    url = f'https://github.com/{self.repo}/releases/download/{self.version}/{param.cfg["model_name"]}.pt'
+                    download(url=url, dir=model_folder, unzip=True)
+            if not resume:
+                # mtime reloads weights overwritten in place (None: name resolved by Ultralytics)
+                mtime = os.path.getmtime(self.model_weights) if os.path.isfile(self.model_weights) else None
+                cache_key = (self.model_weights, mtime)
+                if cache_key not in self._model_cache:
+                    if len(self._model_cache) >= self._model_cache_size:
+                        # Evict the oldest entry
+                        self._model_cache.pop(next(iter(self._model_cache)))
+                    self._model_cache[cache_key] = YOLO(self.model_weights)
+                # Train a copy: Ultralytics swaps in the trained weights at the end of train()
+                self.model = copy.deepcopy(self._model_cache[cache_key])
+
+            # Add custom MLflow callback to the model
+            if param.cfg["enable_mlflow"]:
+                self.model.add_callback(
+                    'on_fit_epoch_end', custom_callbacks.on_fit_epoch_end)
+
+            # Copy batches to GPU on a dedicated CUDA stream
+            if param.cfg["prefetch"]:
+                self.model.add_callback(
+                    'on_train_start', custom_callbacks.on_train_start_prefetch)
+
+            # Validate every val_period epochs only. The callback sets trainer.args.val, which is
+            # saved in checkpoints: always register it on resume so a val=False from a skipped epoch is reset
+            if param.cfg["val"] and (param.cfg["val_period"] > 1 or resume):
+                self.model.add_callback(
+                    'on_train_epoch_start',
+                    functools.partial(custom_callbacks.on_train_epoch_start_val_period,
+                                      val_period=param.cfg["val_period"]))
+
+            # NHWC layout, registered before compilation so Inductor traces the converted model
+            if self.device != "cpu":
+                self.model.add_callback(
+                    'on_pretrain_routine_end', custom_callbacks.on_pretrain_routine_end_channels_last)
+
+            # Compile the model with TorchInductor: first iteration pays the JIT cost
+            # so only worth it on GPU and for runs of several epochs
+            epochs = config_file.get("epochs", param.cfg["epochs"]) \
+                if param.cfg["config_file"] else param.cfg["epochs"]
+            if hasattr(torch, "compile") and self.device != "cpu" and epochs >= 3:
+                self.model.add_callback(
+                    'on_pretrain_routine_end', custom_callbacks.on_pretrain_routine_end_compile)
+                self.model.add_callback(
+                    'on_train_epoch_start', custom_callbacks.on_train_epoch_start_compile)
+                self.model.add_callback(
+                    'on_train_epoch_end', custom_callbacks.on_train_epoch_end_compile)
+
+            # Prime cuDNN autotuning on the trainer model at the training batch size
+            if self.device != "cpu":
+                self.model.add_callback(
+                    'on_train_start', custom_callbacks.on_train_start_warmup)
+
+            # Train the model
+            if resume:
+                # Training arguments and optimizer state are restored from the checkpoint
+                self.model.train(resume=True, device=self.device)
+
+            elif param.cfg["config_file"]:
+                self.model.train(**train_args)
+
+            else:
+                self.model.train(
+                    data=dataset_folder,
+                    epochs=param.cfg["epochs"],
+                    imgsz=param.cfg["input_size"],
+                    batch=param.cfg["batch_size"],
+                    workers=param.cfg["workers"],
+                    optimizer=param.cfg["optimizer"],
+                    momentum=param.cfg["momentum"],
+                    weight_decay=param.cfg["weight_decay"],
+                    lr0=param.cfg["lr0"],
+                    lrf=param.cfg["lrf"],
+                    pretrained=True,
+                    amp=param.cfg["amp"],
+                    cache=param.cfg["cache"] or False,
+                    val=param.cfg["val"],
+                    device=self.device,
+                    **train_args,
+                )
+        finally:
+            torch.backends.cuda.matmul.allow_tf32 = prev_backends[0]
+            torch.backends.cudnn.allow_tf32 = prev_backends[1]
+            torch.backends.cudnn.benchmark = prev_backends[2]
+            if prev_matmul_precision is not None:
+                torch.set_float32_matmul_precision(prev_matmul_precision)
+            torch.set_num_threads(prev_num_threads)
+            torch.backends.mkldnn.enabled = prev_mkldnn
+
+            # Reset settings to default values
+            settings.reset()
 
         # Step progress bar (Ikomia Studio):
         self.emit_step_progress()
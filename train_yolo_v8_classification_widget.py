@@ -66,7 +66,7 @@ class TrainYoloV8ClassificationWidget(core.CWorkflowTaskWidget):
 
         # Batch size
         self.spin_batch = pyqtutils.append_spin(
-            self.grid_layout, "Batch size", self.parameters.cfg["batch_size"])
+            self.grid_layout, "Batch size (-1: auto)", self.parameters.cfg["batch_size"], min=-1)
 
         # Hyper-parameters
         custom_hyp = bool(self.parameters.cfg["config_file"])
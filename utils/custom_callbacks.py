@@ -4,6 +4,8 @@ import re
 from pathlib import Path
 
 from ultralytics.utils import LOGGER, TESTS_RUNNING, colorstr
+from ultralytics.utils.torch_utils import de_parallel
+from train_yolo_v8_classification.utils.prefetcher import CUDAPrefetcher
 
 try:
     import mlflow
@@ -57,12 +59,73 @@ def on_pretrain_routine_end(trainer):
 
 def on_fit_epoch_end(trainer):
     """Logs training metrics to Mlflow."""
-    if mlflow:
+    if mlflow and not getattr(trainer, "_val_skipped", False):
         metrics_dict = {f"{re.sub('[()]', '', k)}": float(v)
                         for k, v in trainer.metrics.items()}
         mlflow.log_metrics(metrics=metrics_dict, step=trainer.epoch)
 
 
+def on_pretrain_routine_end_channels_last(trainer):
+    """Converts the training model to NHWC layout for tensor-core convolutions."""
+    if trainer.device.type == "cuda":
+        trainer.model.to(memory_format=torch.channels_last)
+
+
+def on_pretrain_routine_end_compile(trainer):
+    """Compiles the training model forward with TorchInductor."""
+    try:
+        model = de_parallel(trainer.model)
+        # Kept on the trainer: the compiled closure can not be pickled with the model
+        trainer._compiled_forward = torch.compile(model.forward, mode="reduce-overhead",
+                                                  fullgraph=False, dynamic=False)
+        LOGGER.info("torch.compile enabled (mode=reduce-overhead)")
+    except Exception as err:
+        LOGGER.warning(f"torch.compile skipped - {repr(err)}")
+
+
+def on_train_epoch_start_compile(trainer):
+    """Attaches the compiled forward for the training epoch."""
+    forward = getattr(trainer, "_compiled_forward", None)
+    if forward is not None:
+        de_parallel(trainer.model).forward = forward
+
+
+def on_train_epoch_end_compile(trainer):
+    """Detaches the compiled forward before validation and checkpoint saving."""
+    de_parallel(trainer.model).__dict__.pop("forward", None)
+
+
+def on_train_start_warmup(trainer):
+    """Runs one forward pass at the training batch size so cuDNN autotuning happens before the first epoch."""
+    if trainer.device.type != "cuda":
+        return
+    model = de_parallel(trainer.model)
+    imgsz = trainer.args.imgsz
+    dummy = torch.zeros(trainer.batch_size, 3, imgsz, imgsz, device=trainer.device)
+    # Eval mode leaves BatchNorm statistics untouched, the trainer switches back to train mode each epoch
+    model.eval()
+    with torch.no_grad(), torch.cuda.amp.autocast(enabled=bool(trainer.amp)):
+        model(dummy)
+    model.train()
+    torch.cuda.synchronize(trainer.device)
+
+
+def on_train_start_prefetch(trainer):
+    """Overlaps host to device batch copies with compute."""
+    if trainer.device.type == "cuda":
+        trainer.train_loader = CUDAPrefetcher(trainer.train_loader, trainer.device)
+
+
+def on_train_epoch_start_val_period(trainer, val_period=1):
+    """Validates only every val_period epochs (the last epoch is always validated)."""
+    trainer.args.val = (trainer.epoch + 1) % val_period == 0
+    # trainer.metrics keeps the last validation results on skipped epochs
+    trainer._val_skipped = not trainer.args.val and trainer.epoch + 1 < trainer.epochs
+    if not trainer.args.val:
+        # Stale fitness would overwrite best.pt with unvalidated weights
+        trainer.fitness = None
+
+
 def on_train_end(trainer):
     """Called at end of train loop to log model artifact info."""
     if mlflow:
@@ -0,0 +1,52 @@
+import torch
+from ultralytics.utils import LOGGER
+
+
+class CUDAPrefetcher:
+    """Wraps a dataloader to copy the next batch to GPU on a side stream while the current step runs."""
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+        self.iterator = None
+        self.batch = None
+        if not getattr(loader, "pin_memory", False):
+            LOGGER.warning("CUDAPrefetcher: dataloader memory is not pinned, copies will not overlap compute")
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        # Delegate dataset, sampler, reset()... to the wrapped dataloader
+        loader = self.__dict__.get("loader")
+        if loader is None:
+            # Not initialized yet (copy, unpickling)
+            raise AttributeError(name)
+        return getattr(loader, name)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self.preload()
+        while self.batch is not None:
+            yield self.next()
+
+    def preload(self):
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.batch = {k: v.to(self.device, non_blocking=True) if isinstance(v, torch.Tensor) else v
+                          for k, v in batch.items()}
+
+    def next(self):
+        torch.cuda.current_stream(self.device).wait_stream(self.stream)
+        batch = self.batch
+        # Tensors were allocated on the copy stream but are consumed on the compute stream
+        for v in batch.values():
+            if isinstance(v, torch.Tensor):
+                v.record_stream(torch.cuda.current_stream(self.device))
+        self.preload()
+        return batch